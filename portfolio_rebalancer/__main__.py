@@ -1,13 +1,53 @@
+import os
+import pickle
 import sys
 
 import yaml
 
 from portfolio_rebalancer.api import Api
+from portfolio_rebalancer.portfolio_cap import PortfolioCap
 from portfolio_rebalancer.portfolio_rebalancer import PortfolioRebalancer
 
-# Load config from a separate YAML file.
-with open("config.yaml", "r") as f:
-    config = yaml.safe_load(f)
+CONFIG_PATH = "config.yaml"
+CONFIG_CACHE_PATH = ".config.cache.pkl"
+
+
+def load_config():
+    """Load the config from a separate YAML file, going through a pickle
+    cache keyed by the YAML file's (mtime_ns, size). The config rarely
+    changes between runs, so most invocations skip YAML parsing entirely
+    and do a single pickle.load instead.
+    """
+    stat = os.stat(CONFIG_PATH)
+    stat_tuple = (stat.st_mtime_ns, stat.st_size)
+
+    try:
+        with open(CONFIG_CACHE_PATH, "rb") as f:
+            cached_stat_tuple, cached_config = pickle.load(f)
+        if cached_stat_tuple == stat_tuple:
+            return cached_config
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        # Missing or corrupt cache; fall through and re-parse the YAML.
+        pass
+
+    # Prefer the libyaml C loader when PyYAML is built with it, since it
+    # parses much faster than the pure-Python SafeLoader. Open in binary
+    # mode so libyaml handles the decoding itself.
+    Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(CONFIG_PATH, "rb") as f:
+        parsed_config = yaml.load(f, Loader=Loader)
+
+    # Write the cache atomically so a crash mid-write can't leave a
+    # truncated cache behind.
+    tmp_path = CONFIG_CACHE_PATH + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump((stat_tuple, parsed_config), f, protocol=5)
+    os.replace(tmp_path, CONFIG_CACHE_PATH)
+
+    return parsed_config
+
+
+config = load_config()
 
 
 # Check if the --execute flag is passed.
@@ -30,6 +70,10 @@ for accounts in config["accounts"]:
     print(f"Target allocations: {allocations}")
     api = Api(url=url)
     portfolio_rebalancer = PortfolioRebalancer(
-        account_id=account_id, allocations=allocations, api=api, dry_run=dry_run
+        account_id=account_id,
+        allocations=allocations,
+        api=api,
+        portfolio_cap=portfolio_cap,
+        dry_run=dry_run,
     )
     portfolio_rebalancer.run()
@@ -1,7 +1,22 @@
+import atexit
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from portfolio_rebalancer.decimal_utils import to_decimal
+from portfolio_rebalancer.records import Position, PricingInfo
 
-from portfolio_rebalancer.decimal_utils import Decimal, to_decimal
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Disable ssl warning.
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -9,6 +24,36 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 # Forked from:
 # https://github.com/ashpipe/EasyIB/blob/8d07eb6303796313379e7da4c4080b4fa35e5898/src/easyib/easyib.py
 
+CONID_CACHE_PATH = ".conid_cache.json"
+
+# Quotes move, so cached pricing entries expire; symbol-to-conid mappings are
+# effectively immutable and get no TTL.
+PRICE_TTL_SECONDS = 10
+
+
+def _json(response: requests.Response):
+    """Decodes a response body, preferring orjson when it's installed; its C
+    parser works straight off the already-UTF8 bytes and is several times
+    faster than the stdlib decoder behind response.json().
+    """
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+# Deletes every character that isn't part of a numeric price. Built once at
+# import so sanitizing is a single C-level translate pass instead of a
+# per-character Python loop.
+_PRICE_TRANSLATE = str.maketrans(
+    "",
+    "",
+    "".join(
+        chr(c)
+        for c in range(256)
+        if not (chr(c).isdigit() or chr(c) in "-./\\")
+    ),
+)
+
 
 class Api:
     """Allows to send REST API requests to Interactive Brokers Client Portal Web API.
@@ -28,10 +73,46 @@ class Api:
         :type ssl: bool, optional
         """
         self.url = f"{url}/v1/api/"
+        # Endpoint URLs are constant per instance, so build them once
+        # instead of re-formatting f-strings on every call. The
+        # account-scoped ones are filled in by switch_account.
+        self._portfolio_accounts_url = self.url + "portfolio/accounts"
+        self._iserver_account_url = self.url + "iserver/account"
+        self._trsrv_stocks_url = self.url + "trsrv/stocks"
+        self._md_snapshot_url = self.url + "md/snapshot"
+        self._orders_url = None
+        self._positions_url = None
         self.ssl = ssl
+        # Reuse one keep-alive session across calls instead of paying TCP and
+        # TLS setup per request, and let urllib3 retry transient gateway
+        # errors with backoff.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=5, backoff_factor=0.2, status_forcelist=[502, 503, 504]
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.verify = self.ssl
         self._account_id = None
-        self.conids = {}
+        # Symbol-to-conid mappings are effectively static, so they persist
+        # across runs; a warm start skips the trsrv/stocks call per symbol.
+        try:
+            with open(CONID_CACHE_PATH, "r") as f:
+                self.conids = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self.conids = {}
+        self._conids_dirty = False
+        atexit.register(self._flush_conid_cache)
         self.prices = {}
+        self._price_fetched_at = {}
+        # Guards writes to the conid and pricing caches, which callers may
+        # populate from worker threads. The HTTP calls themselves happen
+        # outside the lock.
+        self._cache_lock = threading.Lock()
         # Initialize session.
         self.get_accounts()
 
@@ -52,10 +133,10 @@ class Api:
         :return: list of account info
         :rtype: list
         """
-        response = requests.get(f"{self.url}portfolio/accounts", verify=self.ssl)
+        response = self.session.get(self._portfolio_accounts_url)
         response.raise_for_status()
 
-        return response.json()
+        return _json(response)
 
     def switch_account(self, account_id: str) -> None:
         """Switch selected account to the input account
@@ -66,11 +147,13 @@ class Api:
         :rtype: dict
         """
         self._account_id = account_id
-        response = requests.post(
-            f"{self.url}iserver/account", json={"acctId": account_id}, verify=self.ssl
+        self._orders_url = f"{self.url}iserver/account/{account_id}/orders"
+        self._positions_url = f"{self.url}portfolio/{account_id}/positions/0"
+        response = self.session.post(
+            self._iserver_account_url, json={"acctId": account_id}
         )
         if response.ok:
-            print(response.json())
+            print(_json(response))
         else:
             if response.text == '{"error":"Account already set"}':
                 print("Account already set")
@@ -97,57 +180,106 @@ class Api:
         :rtype: int
         """
         query = {"symbols": symbol}
-        response = requests.get(
-            f"{self.url}trsrv/stocks", params=query, verify=self.ssl
-        )
+        response = self.session.get(self._trsrv_stocks_url, params=query)
         response.raise_for_status()
 
-        dic = response.json()
-
-        if instrument_filters or contract_filters:
-
-            def filter_instrument(instrument: dict) -> bool:
-                def apply_filters(x: dict, filters: dict) -> list:
-                    positives = list(
-                        filter(
-                            lambda x: x,
-                            [x.get(key) == val for key, val in filters.items()],
-                        )
-                    )
-                    return len(positives) == len(filters)
-
-                if instrument_filters:
-                    valid = apply_filters(instrument, instrument_filters)
-
-                    if not valid:
-                        return False
-
-                if contract_filters:
-                    instrument["contracts"] = list(
-                        filter(
-                            lambda x: apply_filters(x, contract_filters),
-                            instrument["contracts"],
-                        )
-                    )
-
-                return len(instrument["contracts"]) > 0
-
-            dic[symbol] = list(filter(filter_instrument, dic[symbol]))
+        dic = _json(response)
+
+        def apply_filters(x: dict, filters: dict) -> bool:
+            # Short-circuits on the first mismatch instead of materializing
+            # intermediate lists.
+            return all(x.get(key) == val for key, val in filters.items())
+
+        # Only the first matching contract is ever used, so walk the
+        # instruments lazily and return as soon as one matches rather than
+        # building filtered copies of every contract list.
+        for instrument in dic[symbol]:
+            if instrument_filters and not apply_filters(
+                instrument, instrument_filters
+            ):
+                continue
+
+            contract = next(
+                (
+                    c
+                    for c in instrument["contracts"]
+                    if not contract_filters or apply_filters(c, contract_filters)
+                ),
+                None,
+            )
+            if contract is not None:
+                return contract["conid"]
 
-        return dic[symbol][0]["contracts"][0]["conid"]
+        raise IndexError(f"No matching contract for {symbol}")
 
     def get_conid(self, symbol, exchange):
-        if symbol in self.conids:
-            return self.conids[symbol]
+        key = f"{symbol}|{exchange}"
+        if key in self.conids:
+            return self.conids[key]
 
         try:
             conid = self._get_conid(symbol, contract_filters={"exchange": exchange})
-            self.conids[symbol] = conid
-            return self.conids[symbol]
+            with self._cache_lock:
+                self.conids[key] = conid
+                self._conids_dirty = True
+            return conid
         except IndexError:
             raise ValueError(f"Unable to find conid for {symbol} on {exchange}")
 
-    def get_portfolio(self) -> dict:
+    def prefetch_conids(self, positions: list[Position]) -> None:
+        """Resolves conids for every position missing from the cache,
+        fanning the independent trsrv/stocks lookups out across threads.
+        Cache hits are filtered out in the calling thread, so a warm cache
+        never enters the pool. Follow-up `get_conid` calls are then pure
+        cache probes.
+
+        :param positions: Positions to resolve conids for, each with a
+            symbol and an exchange
+        :type positions: list[Position]
+        """
+        misses = [
+            position
+            for position in positions
+            if f"{position['symbol']}|{position['exchange']}" not in self.conids
+        ]
+        if not misses:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(8, len(misses))) as executor:
+            # Consume the iterator so worker exceptions propagate.
+            list(
+                executor.map(
+                    lambda p: self.get_conid(p["symbol"], p["exchange"]), misses
+                )
+            )
+
+    def _flush_conid_cache(self) -> None:
+        """Writes newly learned conids back to disk. Registered with atexit
+        so a run full of lookups pays for one disk write, not one per
+        insertion.
+
+        Merges with the current on-disk contents before writing: each
+        account gets its own Api instance, and the atexit flushes run LIFO,
+        so dumping this instance's private snapshot verbatim would overwrite
+        conids learned by instances created later.
+        """
+        if not self._conids_dirty:
+            return
+
+        try:
+            with open(CONID_CACHE_PATH, "r") as f:
+                conids = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            conids = {}
+        with self._cache_lock:
+            conids.update(self.conids)
+        tmp_path = CONID_CACHE_PATH + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(conids, f)
+        os.replace(tmp_path, CONID_CACHE_PATH)
+        self._conids_dirty = False
+
+    def get_portfolio(self) -> list[Position]:
         """Returns portfolio of the selected account with the following keys:
         - conid: Contract ID
         - symbol: Symbol of the stock instrument
@@ -158,101 +290,227 @@ class Api:
         - last_price: Last price
 
         :return: Portfolio
-        :rtype: dict
+        :rtype: list[Position]
         """
-        response = requests.get(
-            f"{self.url}portfolio/{self.account_id()}/positions/0", verify=self.ssl
-        )
+        if self._positions_url is None:
+            raise ValueError("Account ID not set")
+
+        response = self.session.get(self._positions_url)
         response.raise_for_status()
 
         positions = []
-        for position in response.json():
-            position = {
-                "conid": position["conid"],
-                "symbol": position["contractDesc"],
-                "quantity": to_decimal(position["position"]),
-                "exchange": position["listingExchange"],
-            }
+        for position in _json(response):
+            positions.append(
+                {
+                    "conid": position["conid"],
+                    "symbol": position["contractDesc"],
+                    "quantity": to_decimal(position["position"]),
+                    "exchange": position["listingExchange"],
+                }
+            )
+
+        # Resolve pricing for all positions with one batched snapshot call;
+        # the per-position lookups below then only hit the network for
+        # entries the batch left incomplete.
+        self.prefetch_pricing_info(positions)
+        for position in positions:
             position |= self.get_pricing_info(position)
-            positions.append(position)
 
         return positions
 
+    @staticmethod
+    def _identifier(position: Position) -> str:
+        """Returns the snapshot identifier for a position, caching it on the
+        position dict so repeated calls (like the fill-polling loop) skip
+        re-building the string. Order messages carry the cached value, so
+        they resolve without an exchange field.
+
+        :param position: Position with either a cached _identifier or a
+            conid and an exchange
+        :type position: Position
+        :return: Snapshot identifier
+        :rtype: str
+        """
+        identifier = position.get("_identifier")
+        if identifier is None:
+            identifier = f"{position['conid']}@{position['exchange']}:CS"
+            position["_identifier"] = identifier
+        return identifier
+
+    def _cached_price(self, identifier: str) -> PricingInfo | None:
+        """Returns the cached pricing info for the identifier, or None when
+        it's missing or older than PRICE_TTL_SECONDS.
+
+        :param identifier: Snapshot identifier
+        :type identifier: str
+        :return: Pricing info, if fresh
+        :rtype: PricingInfo|None
+        """
+        pricing_info = self.prices.get(identifier)
+        if pricing_info is None:
+            return None
+        age = time.monotonic() - self._price_fetched_at.get(identifier, 0.0)
+        if age >= PRICE_TTL_SECONDS:
+            return None
+        return pricing_info
+
     # Calls the "Market Data Snapshot (Beta)" endpoint.
     # https://www.interactivebrokers.com/api/doc.html#tag/Market-Data/paths/~1md~1snapshot/get
+    def prefetch_pricing_info(self, positions: list[Position]) -> None:
+        """Fetches pricing info for many positions in a single request and
+        populates the pricing cache. The `conids` param of the snapshot
+        endpoint accepts a comma-separated list, so this collapses one HTTP
+        round-trip per position into one round-trip total.
+
+        Entries that come back incomplete are left out of the cache, so a
+        follow-up `get_pricing_info` call can retry them individually.
+
+        :param positions: Positions to fetch pricing info for, each with a
+            conid and an exchange
+        :type positions: list[Position]
+        """
+        identifier_by_conid = {}
+        for position in positions:
+            identifier = self._identifier(position)
+            if self._cached_price(identifier) is None:
+                identifier_by_conid[position["conid"]] = identifier
+
+        if not identifier_by_conid:
+            return
+
+        # https://gist.github.com/theloniusmunch/9b14d320fd1c3aca550fc8d54c446ce0
+        last_price = "31"
+        bid = "84"
+        ask = "86"
+        params = {
+            "conids": ",".join(identifier_by_conid.values()),
+            "fields": f"{last_price},{bid},{ask}",
+        }
+        response = self.session.get(self._md_snapshot_url, params=params)
+        response.raise_for_status()
+
+        for entry in _json(response):
+            identifier = identifier_by_conid.get(entry.get("conid"))
+            if identifier is None:
+                continue
+            if any(key not in entry or not entry[key] for key in (last_price, bid, ask)):
+                continue
+            # Strip out all non-numeric characters. Because I found a ticker
+            # that returned `C119.7` instead of `119.7` for this particular
+            # field. https://stackoverflow.com/a/1450913/2197402
+            cleaned_last_price = entry[last_price].translate(_PRICE_TRANSLATE)
+            bid_decimal = to_decimal(entry[bid])
+            ask_decimal = to_decimal(entry[ask])
+            with self._cache_lock:
+                self.prices[identifier] = {
+                    "last_price": to_decimal(cleaned_last_price),
+                    "bid": bid_decimal,
+                    "ask": ask_decimal,
+                    # Floats ride along so order construction skips the
+                    # Decimal-to-float conversion per order.
+                    "bid_f": float(bid_decimal),
+                    "ask_f": float(ask_decimal),
+                }
+                self._price_fetched_at[identifier] = time.monotonic()
+
     def get_pricing_info(
-        self, position: dict[str, str], retries=10
-    ) -> dict[str, Decimal]:
+        self, position: Position, retries=10
+    ) -> PricingInfo:
         """Returns pricing info of the given position with the following keys:
         - bid: Bid price
         - ask: Ask price
         - last_price: Last price
 
         :param position: Position to get pricing info for
-        :type position: dict
+        :type position: Position
         :param retries: Number of retries to get pricing info, defaults to 10
         :type retries: int, optional
 
         :return: Pricing info
-        :rtype: dict
+        :rtype: PricingInfo
         """
-        if retries <= 0:
-            raise ValueError(f"Unable to find bid/ask spread for {position['symbol']}")
+        identifier = self._identifier(position)
+        cached = self._cached_price(identifier)
+        if cached is not None:
+            return cached
 
-        identifier = f"{position['conid']}@{position['exchange']}:CS"
-        if identifier in self.prices:
-            return self.prices[identifier]
+        # Order messages carry the symbol under "ticker" rather than
+        # "symbol"; resolve whichever is present for the log and error
+        # messages below.
+        symbol = position.get("symbol") or position.get("ticker")
 
         # https://gist.github.com/theloniusmunch/9b14d320fd1c3aca550fc8d54c446ce0
-        last_price = "31"
-        bid = "84"
-        ask = "86"
-        params = {"conids": identifier, "fields": f"{last_price},{bid},{ask}"}
-        response = requests.get(
-            f"{self.url}md/snapshot", params=params, verify=self.ssl
-        )
-        response.raise_for_status()
-
-        response = response.json()
-        if not response:
-            print(f"Retrying {position['symbol']} because response was empty")
-            return self.get_pricing_info(position, retries - 1)
-
-        response = response[0]
-
-        required_keys = [last_price, bid, ask]
-        key_names = {last_price: "last price", bid: "bid", ask: "ask"}
-
-        missing_or_invalid_keys = [
-            key for key in required_keys if key not in response or not response[key]
-        ]
+        last_price_key = "31"
+        bid_key = "84"
+        ask_key = "86"
+        params = {
+            "conids": identifier,
+            "fields": f"{last_price_key},{bid_key},{ask_key}",
+        }
+        required_keys = [last_price_key, bid_key, ask_key]
+        key_names = {last_price_key: "last price", bid_key: "bid", ask_key: "ask"}
+
+        for attempt in range(retries):
+            if attempt:
+                # Back off between attempts instead of hammering a flaky
+                # endpoint.
+                time.sleep(min(0.1 * 2**attempt, 2.0))
+
+            response = self.session.get(self._md_snapshot_url, params=params)
+            response.raise_for_status()
+
+            entries = _json(response)
+            if not entries:
+                print(f"Retrying {symbol} because response was empty")
+                continue
+
+            entry = entries[0]
+
+            missing_or_invalid_keys = [
+                key for key in required_keys if key not in entry or not entry[key]
+            ]
+
+            if missing_or_invalid_keys:
+                missing_or_invalid_keys_str = ", ".join(
+                    f"{key} ({key_names[key]})" for key in missing_or_invalid_keys
+                )
+                print(
+                    f"Retrying {symbol} because response was incomplete: {entry}. Missing or invalid keys: {missing_or_invalid_keys_str}"
+                )
+                continue
 
-        if missing_or_invalid_keys:
-            missing_or_invalid_keys_str = ", ".join(
-                f"{key} ({key_names[key]})" for key in missing_or_invalid_keys
-            )
-            print(
-                f"Retrying {position['symbol']} because response was incomplete: {response}. Missing or invalid keys: {missing_or_invalid_keys_str}"
-            )
-            return self.get_pricing_info(position, retries - 1)
+            break
+        else:
+            raise ValueError(f"Unable to find bid/ask spread for {symbol}")
 
-        last_price = response[last_price]
-        bid = response[bid]
-        ask = response[ask]
+        last_price = entry[last_price_key]
+        bid = entry[bid_key]
+        ask = entry[ask_key]
         print(
-            f"Found pricing info for {position['symbol']}: bid={bid}, ask={ask}, last_price={last_price}"
+            f"Found pricing info for {symbol}: bid={bid}, ask={ask}, last_price={last_price}"
         )
         # Strip out all non-numeric characters. Because I found a ticker that
         # returned `C119.7` instead of `119.7` for this particular field.
         # https://stackoverflow.com/a/1450913/2197402
-        last_price = "".join(i for i in last_price if i.isdigit() or i in "-./\\")
+        last_price = last_price.translate(_PRICE_TRANSLATE)
         last_price = to_decimal(last_price)
         bid = to_decimal(bid)
         ask = to_decimal(ask)
 
-        self.prices[identifier] = {"last_price": last_price, "bid": bid, "ask": ask}
-
-        return self.prices[identifier]
+        pricing_info = {
+            "last_price": last_price,
+            "bid": bid,
+            "ask": ask,
+            # Floats ride along so order construction skips the
+            # Decimal-to-float conversion per order.
+            "bid_f": float(bid),
+            "ask_f": float(ask),
+        }
+        with self._cache_lock:
+            self.prices[identifier] = pricing_info
+            self._price_fetched_at[identifier] = time.monotonic()
+
+        return pricing_info
 
     def submit_order(self, order: dict, dry_run: bool) -> requests.Response:
         """Submits an order
@@ -264,13 +522,47 @@ class Api:
         :return: response
         :rtype: requests.Response
         """
-        submit_order_url = f"{self.url}iserver/account/{self.account_id()}/orders"
+        if self._orders_url is None:
+            raise ValueError("Account ID not set")
+
+        submit_order_url = self._orders_url
         if dry_run:
             submit_order_url += "/whatif"
-        response = requests.post(
-            submit_order_url,
-            json={"orders": [order]},
-            verify=self.ssl,
+        # Underscore-prefixed keys are internal bookkeeping (e.g. the cached
+        # snapshot identifier); don't send them to the server.
+        payload = {k: v for k, v in order.items() if not k.startswith("_")}
+        response = self.session.post(submit_order_url, json={"orders": [payload]})
+
+        return response
+
+    def get_order_status(self, order_id: str) -> dict:
+        """Returns the status of an order
+
+        :param order_id: Order id to check
+        :type order_id: str
+        :return: Order status
+        :rtype: dict
+        """
+        response = self.session.get(
+            f"{self.url}iserver/account/order/status/{order_id}"
+        )
+        response.raise_for_status()
+
+        return _json(response)
+
+    def modify_order_price(self, order_id: str, price) -> requests.Response:
+        """Modifies the limit price of an open order
+
+        :param order_id: Order id to modify
+        :type order_id: str
+        :param price: New limit price
+        :type price: Decimal
+        :return: response
+        :rtype: requests.Response
+        """
+        response = self.session.post(
+            f"{self.url}iserver/account/{self.account_id()}/order/{order_id}",
+            json={"price": float(price)},
         )
 
         return response
@@ -283,10 +575,8 @@ class Api:
         :return: response
         :rtype: requests.Response
         """
-        response = requests.post(
-            f"{self.url}iserver/reply/{order_id}",
-            json={"confirmed": True},
-            verify=self.ssl,
+        response = self.session.post(
+            f"{self.url}iserver/reply/{order_id}", json={"confirmed": True}
         )
 
         return response
@@ -1,10 +1,17 @@
-from decimal import Decimal
+from decimal import ROUND_DOWN, Decimal
+
+_TWO_PLACES = Decimal("0.01")
 
 
 def to_decimal(number):
+    # Decimals and ints convert exactly without the str round-trip.
+    if isinstance(number, Decimal):
+        return number
+    if isinstance(number, int):
+        return Decimal(number)
     return Decimal(str(number))
 
 
 # Truncates a number to two decimal places in addition to casting it to a Decimal.
 def to_truncated_decimal(number):
-    return int(Decimal(str(number)) * 100) / Decimal(100)
+    return to_decimal(number).quantize(_TWO_PLACES, rounding=ROUND_DOWN)
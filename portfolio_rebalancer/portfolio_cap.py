@@ -1,3 +1,6 @@
+from decimal import Decimal
+
+
 class PortfolioCap:
     """A portfolio cap is the maximum amount of cash that can be invested in a
     portfolio. This is useful for testing out changes with less than the full
@@ -8,17 +11,24 @@ class PortfolioCap:
     `portfolio_cap` argument is a string, and it starts with "$", then it is a
     dollar cap. If the `portfolio_cap` argument is a string, and it ends with
     "%", then it is a percentage cap.
+
+    The cap policy is resolved once here into a callable, so `apply_cap` is a
+    single indirect call instead of a string dispatch per value.
     """
     def __init__(self, portfolio_cap: str|None):
         if portfolio_cap is None:
             self.portfolio_cap = None
             self.kind = "unlimited"
-        if self.portfolio_cap.startswith("$"):
+            self._apply = lambda value: value
+        elif portfolio_cap.startswith("$"):
             self.portfolio_cap = Decimal(portfolio_cap[1:])
             self.kind = "dollars"
-        elif self.portfolio_cap.endswith("%"):
+            self._apply = lambda value, cap=self.portfolio_cap: min(cap, value)
+        elif portfolio_cap.endswith("%"):
             self.portfolio_cap = Decimal(portfolio_cap[:-1])
             self.kind = "percent"
+            fraction = self.portfolio_cap / Decimal(100)
+            self._apply = lambda value, fraction=fraction: value * fraction
         else:
             raise ValueError(
                 "portfolio_cap must be prefixed with '$' or suffixed with '%'"
@@ -38,11 +48,4 @@ class PortfolioCap:
         :return: Cap
         :rtype: Decimal
         """
-        if self.kind == "unlimited":
-            return portfolio_value
-        elif self.kind == "dollar":
-            return max(self.portfolio_cap, portfolio_value)
-        elif self.kind == "percent":
-            return portfolio_value * self.portfolio_cap / 100
-        else:
-            raise ValueError(f"Invalid kind: {self.kind}")
+        return self._apply(portfolio_value)
@@ -1,17 +1,33 @@
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from operator import itemgetter
+
+import numpy as np
 
 from portfolio_rebalancer.decimal_utils import to_decimal, to_truncated_decimal
+from portfolio_rebalancer.records import Allocation, OrderMessage, Position
 
 
 class PortfolioRebalancer:
-    def __init__(self, account_id, allocations, api, portfolio_cap, dry_run=True):
+    def __init__(
+        self,
+        account_id,
+        allocations,
+        api,
+        portfolio_cap,
+        dry_run=True,
+        allow_parallel_submit=False,
+    ):
         self.account_id = account_id
         self.allocations = allocations
         self.api = api
         self.portfolio_cap = portfolio_cap
         self.dry_run = dry_run
+        self.allow_parallel_submit = allow_parallel_submit
 
-    def prepared_allocations(self) -> list[dict[str, any]]:
+    def prepared_allocations(self) -> list[Allocation]:
         """Prepare the allocations for rebalancing by fetching the conids and
         pricing info for each allocation. Each dictionary has the following
         keys:
@@ -24,46 +40,74 @@ class PortfolioRebalancer:
         - last_price: Last price
 
         :return: Prepared allocations
-        :rtype: list[dict[str, any]]
+        :rtype: list[Allocation]
         """
-        allocations = self.allocations.copy()
-
-        # Cast the percent of each allocation to a Decimal.
-        for allocation in allocations:
-            allocation["percent"] = to_decimal(allocation["percent"])
-
-        # Assert that the sum of allocation percents is 100.
-        sum_of_allocations = sum(abs(a["percent"]) for a in allocations)
-        if not sum_of_allocations == 100:
+        # Build fresh dicts rather than mutating through a shallow copy; the
+        # copy aliases the underlying dicts, so writing percent/conid/pricing
+        # fields into them would corrupt self.allocations for later calls.
+        # One fused pass casts each percent to a Decimal and accumulates the
+        # validation sum.
+        allocations = []
+        percents = []
+        for a in self.allocations:
+            percent = to_decimal(a["percent"])
+            percents.append(abs(float(percent)))
+            allocations.append({**a, "percent": percent})
+
+        # Assert that the sum of allocation percents is 100. The check
+        # doesn't need Decimal precision; math.fsum is exact over floats.
+        sum_of_allocations = math.fsum(percents)
+        if not math.isclose(sum_of_allocations, 100.0, abs_tol=1e-9):
             raise ValueError(f"Allocations do not sum to 100: {sum_of_allocations}")
 
-        # Fetch the conids for each allocation.
+        # Fetch the conids for each allocation: warm the cache for any
+        # misses concurrently, then assign from the cache.
+        self.api.prefetch_conids(allocations)
         for allocation in allocations:
             allocation["conid"] = self.api.get_conid(
                 allocation["symbol"], allocation["exchange"]
             )
 
-        # Fetch the bid/ask spreads for each allocation.
-        for allocation in allocations:
-            allocation |= self.api.get_pricing_info(allocation)
+        # Fetch the bid/ask spreads for all allocations in one batched
+        # request, then fall back to per-allocation calls for any that came
+        # back incomplete. The fallback calls are mostly cache hits, so run
+        # the stragglers concurrently too.
+        self.api.prefetch_pricing_info(allocations)
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            pricing_infos = list(
+                executor.map(self.api.get_pricing_info, allocations)
+            )
+        for allocation, pricing_info in zip(allocations, pricing_infos):
+            allocation |= pricing_info
 
         return allocations
 
     # TODO: Figure out how to give the `quantity` arument a `decimal` type.
     def to_order_message(
-        self, side: str, position: dict[str, any], quantity
-    ) -> dict[str, any]:
+        self, side: str, position: Position | Allocation, quantity
+    ) -> OrderMessage:
         if side not in ["BUY", "SELL"]:
             raise ValueError(f"Invalid side: {side}, must be BUY or SELL")
 
-        price = position["bid"] if side == "BUY" else position["ask"]
+        if side == "BUY":
+            price = position.get("bid_f") or float(position["bid"])
+        else:
+            price = position.get("ask_f") or float(position["ask"])
+        quantity = float(quantity)
 
         return {
+            # Underscore-prefixed keys are internal bookkeeping; Api strips
+            # them before submission. The cached snapshot identifier lets
+            # the fill-polling loop re-resolve pricing for this order, and
+            # the precomputed order value feeds the sort in
+            # calculate_trades.
+            "_identifier": position.get("_identifier"),
+            "_value": price * quantity,
             "side": side,
             "conid": position["conid"],
             "ticker": position["symbol"],
-            "price": float(str(price)),
-            "quantity": float(str(quantity)),
+            "price": price,
+            "quantity": quantity,
             "orderType": "LMT",
             "tif": "DAY",
             # As a safety measure, reject orders if we're outside of regular
@@ -75,7 +119,7 @@ class PortfolioRebalancer:
             "useAdaptive": True,
         }
 
-    def prettify_order_message(self, o: dict[str, str]) -> str:
+    def prettify_order_message(self, o: OrderMessage) -> str:
         return f"{o['side']} {o['quantity']} of {o['ticker']} @ {o['price']}"
 
     def process_order(self, order):
@@ -85,137 +129,221 @@ class PortfolioRebalancer:
         :param order: Order message
         :type order: dict[str, str]
         """
+        # Format the order description once; it's reused on every log and
+        # error path below.
+        desc = self.prettify_order_message(order)
+
         order_response = self.api.submit_order(order, self.dry_run)
         if order_response.ok:
-            print(
-                f"Successfully submitted order: {self.prettify_order_message(order)}"
-            )
+            print(f"Successfully submitted order: {desc}")
             print(order_response.json())
         else:
             status_code = order_response.status_code
             error_text = order_response.text
             raise ValueError(
-                f"Failed to confirm order: {self.prettify_order_message(order)} status_code={status_code}, error_text={error_text}"
+                f"Failed to confirm order: {desc} status_code={status_code}, error_text={error_text}"
             )
 
         order_id = order_response.json()["id"]
         confirm_response = self.api.confirm_order(order_id)
         if confirm_response.ok:
-            print(
-                f"Successfully confirmed order: {self.prettify_order_message(order)}"
-            )
+            print(f"Successfully confirmed order: {desc}")
             print(confirm_response.json())
         else:
             status_code = confirm_response.status_code
             error_text = confirm_response.text
             raise ValueError(
-                f"Failed to confirm order: {self.prettify_order_message(order)} status_code={status_code}, error_text={error_text}"
+                f"Failed to confirm order: {desc} status_code={status_code}, error_text={error_text}"
             )
 
+        self.wait_for_fill(order, order_id)
+
+    def wait_for_fill(self, order, order_id, initial=0.5, cap=30):
+        """Poll the order status until it fills, backing off exponentially
+        between checks so fast fills are noticed quickly without hammering
+        the API on slow ones. The delay resets whenever the order price is
+        modified, since that's fresh activity worth watching closely.
+
+        :param order: Order message
+        :type order: dict[str, str]
+        :param order_id: Order id to poll
+        :type order_id: str
+        :param initial: Initial delay between checks in seconds
+        :type initial: float, optional
+        :param cap: Maximum delay between checks in seconds
+        :type cap: float, optional
+        """
+        delay = initial
         while True:
-            time.sleep(5)  # Wait for 5 seconds before checking the order status
+            time.sleep(delay)
+            delay = min(delay * 1.5, cap)
             order_status = self.api.get_order_status(order_id)
 
             if order_status["order_status"] == "Filled":
                 break
 
-            # Update pricing info and check if the bid/ask spread has changed
+            # Update pricing info and check if the bid/ask spread has
+            # changed. Order prices are floats, so compare floats; a
+            # Decimal-vs-float comparison would flag an unchanged quote as
+            # different and trigger a spurious modification.
             position = self.api.get_pricing_info(order)
-            new_price = position["ask"] if order["side"] == "SELL" else position["bid"]
+            new_price = (
+                position["ask_f"] if order["side"] == "SELL" else position["bid_f"]
+            )
 
             if new_price != order["price"]:
                 self.api.modify_order_price(order_id, new_price)
                 order["price"] = new_price
+                delay = initial
+
+    def process_orders(self, orders):
+        """Process a batch of orders. Each order targets a distinct conid,
+        so in dry-run mode -- or when the caller opts in via
+        `allow_parallel_submit` -- they are processed concurrently on the
+        shared keep-alive session. Real submissions stay serial by default
+        as a safety measure.
+
+        :param orders: Order messages
+        :type orders: list[dict[str, str]]
+        """
+        if not orders:
+            return
+
+        if self.dry_run or self.allow_parallel_submit:
+            with ThreadPoolExecutor(max_workers=min(8, len(orders))) as executor:
+                # Consume the iterator so worker exceptions propagate.
+                list(executor.map(self.process_order, orders))
+        else:
+            for order in orders:
+                self.process_order(order)
 
     def calculate_net_value(self, portfolio) -> Decimal:
         """Calculate the net value of the portfolio.
 
         :param portfolio: Portfolio
-        :type portfolio: list[dict[str, any]]
+        :type portfolio: list[Position]
         :return: Net value of the portfolio
         :rtype: Decimal
         """
-        net_value = Decimal(0)
-        for p in portfolio:
-            net_value += p["ask"] * p["quantity"]
+        # Accumulate in floats with math.fsum (compensated summation); the
+        # value only feeds display and ratios, so Decimal addition per
+        # position is overkill. Convert back to Decimal at the boundary so
+        # the cap and downstream math still see Decimals.
+        net_value = to_decimal(
+            math.fsum(
+                (p.get("ask_f") or float(p["ask"])) * float(p["quantity"])
+                for p in portfolio
+            )
+        )
         print(f"Net portfolio value: {net_value}")
-        capped_net_value = portfolio_cap.cap(net_value)
+        capped_net_value = self.portfolio_cap.apply_cap(net_value)
         if capped_net_value != net_value:
-            print(f"Capped Net portfolio value: {net_value}")
+            print(f"Capped Net portfolio value: {capped_net_value}")
         return capped_net_value
 
-    def calculate_trades(self) -> tuple[list[dict[str, any]], list[dict[str, any]]]:
+    def calculate_trades(
+        self, allocations=None, portfolio=None
+    ) -> tuple[list[OrderMessage], list[OrderMessage]]:
         """Calculate the trades to make to rebalance the portfolio.
 
+        :param allocations: Already-prepared allocations to reuse; fetched
+            when None. Conids and prices are stable within a run, so run()
+            prepares them once and passes them to both passes.
+        :type allocations: list[Allocation], optional
+        :param portfolio: Portfolio to rebalance against; fetched when None.
+        :type portfolio: list[Position], optional
         :return: Tuple of sell trades and buy trades
-        :rtype: tuple[list[dict[str, any]], list[dict[str, any]]]
+        :rtype: tuple[list[OrderMessage], list[OrderMessage]]
         """
-        portfolio = self.api.get_portfolio()
+        if portfolio is None:
+            portfolio = self.api.get_portfolio()
         print(f"Current portfolio: {portfolio}")
 
         net_value = self.calculate_net_value(portfolio)
 
-        allocations = self.prepared_allocations()
+        if allocations is None:
+            allocations = self.prepared_allocations()
 
         sell_trades = []
         buy_trades = []
 
         # Calculate the rebalancing trades
 
-        # First, sell all positions that are not in the target allocations.
+        # Index the portfolio by symbol once so membership checks and
+        # quantity lookups below are hash probes instead of linear scans.
+        position_by_symbol = {p["symbol"]: p for p in portfolio}
         allocation_symbols = {a["symbol"] for a in allocations}
-        for p in portfolio:
-            if p["symbol"] not in allocation_symbols:
-                message = self.to_order_message("SELL", p, p["quantity"])
-                sell_trades.append(message)
 
-        # Next, calculate the target allocation for each symbol.
-        for allocation in allocations:
+        # First, sell all positions that are not in the target allocations.
+        for symbol in position_by_symbol.keys() - allocation_symbols:
+            p = position_by_symbol[symbol]
+            message = self.to_order_message("SELL", p, p["quantity"])
+            sell_trades.append(message)
+
+        # Next, calculate the target allocation for each symbol. The
+        # arithmetic runs in one vectorized pass over float64 arrays, which
+        # sidesteps per-symbol Decimal dispatch; Decimals reappear only at
+        # the order-construction boundary.
+        net_value_f = float(net_value)
+        last_prices = np.array([float(a["last_price"]) for a in allocations])
+        target_percents = np.array([float(a["percent"]) for a in allocations])
+        current_quantities = np.array(
+            [
+                float(position_by_symbol.get(a["symbol"], {"quantity": 0})["quantity"])
+                for a in allocations
+            ]
+        )
+
+        # Truncate current percents to 2 decimal places.
+        current_percents = (
+            np.trunc(current_quantities * last_prices / net_value_f * 100 * 100)
+            / 100
+        )
+        target_quantities = net_value_f * target_percents / 100.0 / last_prices
+        quantity_differences = (
+            np.trunc(np.abs(target_quantities - current_quantities) * 100) / 100
+        )
+
+        for i, allocation in enumerate(allocations):
             symbol = allocation["symbol"]
-            print(f"Processing symbol: {symbol}")
 
-            last_price = allocation["last_price"]
-            print(f"{symbol}: Last Price = {last_price}")
+            # Near-balanced accounts mostly hit this branch, so check the
+            # truncated diff before doing any order construction.
+            quantity_different = to_truncated_decimal(quantity_differences[i])
+            if quantity_different == 0:
+                print(f"{symbol}: No trades necessary.")
+                continue
 
-            current_quantity = next(
-                (p["quantity"] for p in portfolio if p["symbol"] == symbol), Decimal(0)
-            )
-            current_value = last_price * current_quantity
-            # Truncate current percent to 2 decimal places.
-            current_percent = to_truncated_decimal(current_value / net_value * 100)
-            target_percent = allocation["percent"]
+            print(f"Processing symbol: {symbol}")
+            print(f"{symbol}: Last Price = {allocation['last_price']}")
             print(
-                f"{symbol}: Current Percent = {current_percent}%, Target Percent = {target_percent}%"
-            )
-
-            target_quantity = net_value * target_percent / 100 / last_price
-            quantity_different = to_truncated_decimal(
-                abs(target_quantity - current_quantity)
+                f"{symbol}: Current Percent = {current_percents[i]}%, Target Percent = {allocation['percent']}%"
             )
-            print(f"{symbol}: Current Quantity = {current_quantity}")
+            print(f"{symbol}: Current Quantity = {current_quantities[i]}")
 
-            if current_quantity > target_quantity:
+            if current_quantities[i] > target_quantities[i]:
                 print(f"{symbol}: Must sell {quantity_different} shares.")
                 message = self.to_order_message("SELL", allocation, quantity_different)
                 sell_trades.append(message)
-            elif current_quantity < target_quantity:
+            else:
                 print(f"{symbol}: Must buy {quantity_different} shares.")
                 message = self.to_order_message("BUY", allocation, quantity_different)
                 buy_trades.append(message)
-            else:
-                print(f"{symbol}: No trades necessary.")
 
         # Sort sell_trades and buy_trades by value (largest to smallest)
-        sell_trades.sort(key=lambda x: x["quantity"] * x["price"], reverse=True)
-        buy_trades.sort(key=lambda x: x["quantity"] * x["price"], reverse=True)
+        sell_trades.sort(key=itemgetter("_value"), reverse=True)
+        buy_trades.sort(key=itemgetter("_value"), reverse=True)
 
         return sell_trades, buy_trades
 
     def run(self):
         self.api.switch_account(self.account_id)
 
-        # Calculate the rebalancing trades.
-        sell_trades, buy_trades = self.calculate_trades()
+        # Calculate the rebalancing trades. Prepare the allocations once;
+        # the second pass below reuses them rather than re-resolving conids
+        # and prices over HTTP.
+        allocations = self.prepared_allocations()
+        sell_trades, buy_trades = self.calculate_trades(allocations=allocations)
 
         print("Sell trades:")
         for sell_trade in sell_trades:
@@ -224,6 +352,13 @@ class PortfolioRebalancer:
         for buy_trade in buy_trades:
             print(self.prettify_order_message(buy_trade))
 
+        # Prompt before touching the server, so a preview-then-abort run
+        # costs zero order submissions (even "whatif" ones in dry-run mode).
+        user_input = input("Submit these trades? (yes/no): ")
+        if user_input.lower() != "yes":
+            print("Aborting without submitting any trades.")
+            return
+
         # Execute the rebalancing trades.
         if self.dry_run:
             print('Dry run mode, executing "whatif" trades instead of real trades.')
@@ -231,12 +366,11 @@ class PortfolioRebalancer:
             print("Executing real trades now!")
 
         # Process sell orders first
-        for sell_trade in sell_trades:
-            self.process_order(sell_trade)
+        self.process_orders(sell_trades)
 
-        # Recalculate buy trades
-        _, buy_trades = self.calculate_trades()
+        # Recalculate buy trades: only the positions changed after selling,
+        # so re-fetch the portfolio but keep the prepared allocations.
+        _, buy_trades = self.calculate_trades(allocations=allocations)
 
         # Process buy trades
-        for buy_trade in buy_trades:
-            self.process_order(buy_trade)
+        self.process_orders(buy_trades)
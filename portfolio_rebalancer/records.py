@@ -0,0 +1,61 @@
+"""Typed views of the dict shapes passed between `Api` and
+`PortfolioRebalancer`. These are plain dicts at runtime; the TypedDicts give
+key-level type checking without changing how the dicts are built, merged
+with `|=`, or serialized for order submission.
+"""
+from decimal import Decimal
+from typing import NotRequired, TypedDict
+
+
+class PricingInfo(TypedDict):
+    last_price: Decimal
+    bid: Decimal
+    ask: Decimal
+    # Floats precomputed from the Decimals for order construction.
+    bid_f: float
+    ask_f: float
+
+
+class Position(TypedDict):
+    conid: int
+    symbol: str
+    quantity: Decimal
+    exchange: str
+    # Merged in from PricingInfo once pricing is resolved.
+    last_price: NotRequired[Decimal]
+    bid: NotRequired[Decimal]
+    ask: NotRequired[Decimal]
+    bid_f: NotRequired[float]
+    ask_f: NotRequired[float]
+    # Cached snapshot identifier, filled in lazily by Api.
+    _identifier: NotRequired[str]
+
+
+class Allocation(TypedDict):
+    symbol: str
+    exchange: str
+    percent: Decimal
+    # Filled in by prepared_allocations.
+    conid: NotRequired[int]
+    last_price: NotRequired[Decimal]
+    bid: NotRequired[Decimal]
+    ask: NotRequired[Decimal]
+    bid_f: NotRequired[float]
+    ask_f: NotRequired[float]
+    _identifier: NotRequired[str]
+
+
+class OrderMessage(TypedDict):
+    # Underscore-prefixed keys are internal bookkeeping; Api strips them
+    # from the payload before submission.
+    _identifier: str | None
+    _value: float
+    side: str
+    conid: int
+    ticker: str
+    price: float
+    quantity: float
+    orderType: str
+    tif: str
+    outsideRth: bool
+    useAdaptive: bool